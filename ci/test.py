@@ -690,6 +690,59 @@ class PyrexImageType_base(PyrexTest):
         conf.write_conf()
         self.assertPyrexHostCommand("true")
 
+    @skipIfPrebuilt
+    def test_local_build_skip(self):
+        conf = self.get_config()
+        conf["config"]["buildlocal"] = "1"
+        conf.write_conf()
+
+        # The first rebuild finds the image source unchanged since the
+        # environment was initialized and skips invoking the engine. The
+        # second runs after the build command has changed and must fall
+        # through to a real build
+        output = self.assertPyrexHostCommand(
+            "pyrex-rebuild",
+            "sed -i -e 's/--provider/--quiet --provider/' %s" % self.pyrex_conf,
+            "pyrex-rebuild",
+            quiet_init=True,
+            capture=True,
+        )
+        self.assertEqual(output.count("Getting container image up to date"), 1)
+
+    @skipIfPrebuilt
+    def test_trust_build(self):
+        conf = self.get_config()
+        conf["config"]["buildlocal"] = "1"
+        conf.write_conf()
+
+        buildconf = os.path.join(self.build_dir, "pyrex", "build.json")
+        corrupt = (
+            "python3 -c \"import json; p = '%s'; "
+            "d = json.load(open(p)); "
+            "d['build']['buildid'] += 'x'; "
+            "d['build']['buildhash'] += 'x'; "
+            "json.dump(d, open(p, 'w'))\"" % buildconf
+        )
+
+        # A recorded image ID or source hash that no longer matches
+        # warns on every container command
+        output = self.assertPyrexHostCommand(
+            corrupt, "pyrex-run true", quiet_init=True, capture=True
+        )
+        self.assertIn("buildid for container image", output)
+        self.assertIn("should be rebuilt", output)
+
+        # PYREX_TRUST_BUILD skips both checks
+        output = self.assertPyrexHostCommand(
+            corrupt,
+            "pyrex-run true",
+            quiet_init=True,
+            capture=True,
+            init_env={"PYREX_TRUST_BUILD": "1"},
+        )
+        self.assertNotIn("buildid for container image", output)
+        self.assertNotIn("should be rebuilt", output)
+
     def test_version(self):
         self.assertRegex(
             pyrex.VERSION,
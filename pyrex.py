@@ -17,35 +17,93 @@
 import argparse
 import configparser
 import contextlib
-import glob
-import grp
-import hashlib
+import fnmatch
+import functools
+import http.client
 import json
+import mmap
 import os
-import pwd
 import re
-import resource
 import shlex
-import shutil
+import socket
 import stat
 import subprocess
 import sys
-import tempfile
-import textwrap
 import types
+import urllib.parse
 
 VERSION = "1.10.0"
 
 VERSION_REGEX = re.compile(r"^([0-9]+\.){2}[0-9]+(-.*)?$")
 VERSION_TAG_REGEX = re.compile(r"^v([0-9]+\.){2}[0-9]+(-.*)?$")
+ENGINE_VERSION_REGEX = re.compile(r"(?P<provider>\S+) +version +(?P<version>[^\s,]+)")
 
 THIS_SCRIPT = os.path.abspath(__file__)
 PYREX_ROOT = os.path.dirname(THIS_SCRIPT)
 PYREX_CONFVERSION = "2"
 MINIMUM_DOCKER_VERSION = 17
 
+# Environment variables forwarded to the image build as build arguments
+PROXY_ENV_VARS = ("http_proxy", "https_proxy", "no_proxy")
+
+# Help shown when the container engine can't be run. Pre-wrapped at
+# module scope so no textwrap.fill passes are needed at runtime
+ENGINE_INSTALL_HELP = """\
+For installation instructions, see the docker website. Commonly, one of
+the following is relevant:
+
+  https://docs.docker.com/install/linux/docker-ce/ubuntu/
+  https://docs.docker.com/install/linux/docker-ce/fedora/
+
+After installing docker, give your login account permission to docker
+commands by running:
+
+  sudo usermod -aG docker $USER
+
+After adding your user to the 'docker' group, log out and back in so
+that the new group membership takes effect.
+
+To attempt running the build on your native operating system's set of
+packages, use:
+
+  export PYREX_USE_CONTAINER=0
+  . init-build-env ...
+"""
+
+# Shim script templates. These are kept pre-dedented at module scope so
+# create_shims() only has to format them
+RUN_SCRIPT_TEMPLATE = """\
+#! /bin/sh
+exec {this_script} run {conffile} -- "$@"
+"""
+
+CONFIG_SCRIPT_TEMPLATE = """\
+#! /bin/sh
+exec {this_script} config {conffile} "$@"
+"""
+
+EXEC_SHIM_TEMPLATE = """\
+#! /bin/sh
+exec {runfile} "$(basename $0)" "$@"
+"""
+
+SHELL_SCRIPT_TEMPLATE = """\
+#! /bin/sh
+exec {runfile} {shell} "$@"
+"""
+
+REBUILD_SCRIPT_TEMPLATE = """\
+#! /bin/sh
+exec {this_script} rebuild {conffile}
+"""
+
 
 class Config(configparser.ConfigParser):
+    # All keys are case-sensitive. str returns string arguments
+    # unchanged and, being a builtin, is dispatched without a Python
+    # function call for each key
+    optionxform = staticmethod(str)
+
     def __init__(self, *args, **kwargs):
         super().__init__(
             *args,
@@ -55,15 +113,16 @@ class Config(configparser.ConfigParser):
             **kwargs,
         )
 
-        # All keys are case-sensitive
-        self.optionxform = lambda option: option
-
 
 class ParsingError(Exception):
     pass
 
 
+@functools.lru_cache(maxsize=2)
 def read_default_config(keep_defaults):
+    # The default config template never changes while the process runs,
+    # so the file read and substitution passes are memoized for both
+    # values of keep_defaults
     with open(os.path.join(PYREX_ROOT, "pyrex.ini"), "r") as f:
         line = f.read().replace("@CONFVERSION@", PYREX_CONFVERSION)
         if keep_defaults:
@@ -73,12 +132,22 @@ def read_default_config(keep_defaults):
         return line
 
 
+_user_config_cache = {}
+
+
 def load_config():
     conffile = os.environ.get("PYREXCONFFILE", "")
     if not conffile:
         sys.stderr.write("Pyrex user config file must be defined in $PYREXCONFFILE!\n")
         sys.exit(1)
 
+    # The parsed config cannot be cached across processes because it
+    # captures imported environment variables, but within a process it
+    # only changes if the user config file does
+    key = (conffile, os.stat(conffile).st_mtime_ns)
+    if key in _user_config_cache:
+        return _user_config_cache[key]
+
     # Load the default config, except the version
     user_config = Config()
     user_config.read_string(read_default_config(True))
@@ -94,9 +163,13 @@ def load_config():
     except configparser.DuplicateSectionError:
         pass
 
-    for env in user_config["config"]["envimport"].split():
-        if env in os.environ:
-            user_config["env"][env] = os.environ[env]
+    # The intersection pushes the membership tests into C instead of a
+    # Python-level check per imported name. Sorted so the section
+    # contents don't depend on hash order
+    env_section = user_config["env"]
+    envimport = set(user_config["config"]["envimport"].split())
+    for env in sorted(envimport & os.environ.keys()):
+        env_section[env] = os.environ[env]
 
     user_config.add_section("pyrex")
     user_config["pyrex"]["version"] = VERSION
@@ -114,9 +187,27 @@ def load_config():
         sys.stderr.write("Cannot find pyrex conf version in %s!\n" % conffile)
         sys.exit(1)
 
+    _user_config_cache[key] = user_config
     return user_config
 
 
+_build_config_cache = {}
+
+
+def load_build_config(path):
+    """
+    Loads the build config JSON file, caching the parsed result so that
+    repeated loads in the same process (keyed on the file modification
+    time) don't re-read and re-parse the file
+    """
+    mtime = os.stat(path).st_mtime_ns
+    key = (path, mtime)
+    if key not in _build_config_cache:
+        with open(path, "r") as f:
+            _build_config_cache[key] = json.load(f)
+    return _build_config_cache[key]
+
+
 def stop_coverage():
     """
     Helper to stop coverage reporting
@@ -132,19 +223,112 @@ def stop_coverage():
         pass
 
 
+DOCKER_API_SOCKET = "/var/run/docker.sock"
+
+_docker_api_conn = None
+
+
+def query_docker_api(path):
+    """
+    Performs a GET against the local Docker daemon API socket, which
+    avoids a fork + exec of the CLI client. The connection is kept alive
+    across calls. Returns the decoded JSON response, or None for a 404.
+    Raises OSError or http.client.HTTPException if the socket cannot be
+    used or the daemon reports an error; a broken connection is dropped
+    so the next call starts fresh
+    """
+    global _docker_api_conn
+
+    if _docker_api_conn is None:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(10)
+            sock.connect(DOCKER_API_SOCKET)
+        except OSError:
+            sock.close()
+            raise
+
+        conn = http.client.HTTPConnection("localhost")
+        conn.sock = sock
+        _docker_api_conn = conn
+
+    try:
+        _docker_api_conn.request("GET", path)
+        response = _docker_api_conn.getresponse()
+        body = response.read()
+    except Exception:
+        _docker_api_conn.close()
+        _docker_api_conn = None
+        raise
+
+    if response.status == 404:
+        return None
+    if response.status != 200:
+        # A daemon or proxy error is not the same as "not found"; let
+        # the caller fall back to the CLI like other socket failures
+        raise http.client.HTTPException("HTTP %d from %s" % (response.status, path))
+    return json.loads(body)
+
+
+def query_image_id_api(image):
+    """
+    Asks the Docker daemon for an image ID over its API socket. Returns
+    the image ID, or None if the image does not exist. Raises OSError if
+    the socket cannot be used (e.g. not present or not readable)
+    """
+    info = query_docker_api("/images/%s/json" % urllib.parse.quote(image, safe=":/"))
+    if info is None:
+        return None
+    return info["Id"]
+
+
+_image_id_cache = {}
+
+
 def get_image_id(config, image):
+    engine = config["config"]["engine"]
+
+    # A resolved image ID cannot change out from under a single
+    # invocation, so successful lookups are cached. build_image and
+    # prep_container both resolve the tag in the capture flow; the
+    # second resolution becomes free. Failed lookups are not cached
+    # since a pull or build can make them succeed later
+    key = (engine, image)
+    cached = _image_id_cache.get(key)
+    if cached is not None:
+        return cached
+
     engine_args = [
-        config["config"]["engine"],
+        engine,
         "image",
         "inspect",
         image,
         "--format={{.Id}}",
     ]
-    return (
-        subprocess.check_output(engine_args, stderr=subprocess.DEVNULL)
-        .decode("utf-8")
-        .rstrip()
-    )
+
+    # When the engine is docker and the daemon is local, ask it over the
+    # API socket instead of paying for a CLI client fork + exec. Any
+    # socket problem falls back to the CLI
+    if engine == "docker" and "DOCKER_HOST" not in os.environ:
+        try:
+            image_id = query_image_id_api(image)
+        except (OSError, http.client.HTTPException, ValueError, KeyError):
+            pass
+        else:
+            if image_id is None:
+                # Keep the contract that a missing image raises
+                # CalledProcessError, just like the CLI fallback
+                raise subprocess.CalledProcessError(
+                    1, engine_args, output="No such image: %s" % image
+                )
+            _image_id_cache[key] = image_id
+            return image_id
+
+    image_id = subprocess.check_output(
+        engine_args, stderr=subprocess.DEVNULL, universal_newlines=True
+    ).rstrip()
+    _image_id_cache[key] = image_id
+    return image_id
 
 
 def build_image(config, build_config):
@@ -155,53 +339,16 @@ def build_image(config, build_config):
     try:
         (provider, version) = get_engine_info(config)
     except (subprocess.CalledProcessError, FileNotFoundError):
-        print(
-            textwrap.fill(
-                (
-                    "Unable to run '%s'. Please make sure you have it installed."
-                    + "For installation instructions, see the docker website. Commonly, "
-                    + "one of the following is relevant:"
-                )
-                % engine
-            )
-        )
-        print()
-        print("  https://docs.docker.com/install/linux/docker-ce/ubuntu/")
-        print("  https://docs.docker.com/install/linux/docker-ce/fedora/")
-        print()
-        print(
-            textwrap.fill(
-                "After installing docker, give your login account permission to "
-                + "docker commands by running:"
-            )
-        )
-        print()
-        print("  sudo usermod -aG docker $USER")
-        print()
-        print(
-            textwrap.fill(
-                "After adding your user to the 'docker' group, log out and back in "
-                + "so that the new group membership takes effect."
-            )
-        )
-        print()
-        print(
-            textwrap.fill(
-                "To attempt running the build on your native operating system's set "
-                + "of packages, use:"
-            )
-        )
-        print()
-        print("  export PYREX_USE_CONTAINER=0")
-        print("  . init-build-env ...")
+        print("Unable to run '%s'. Please make sure you have it installed." % engine)
         print()
+        print(ENGINE_INSTALL_HELP)
         return None
 
     if provider is None:
         sys.stderr.write("Could not get container engine version!\n")
         return None
 
-    if provider == "docker" and int(version.split(".")[0]) < MINIMUM_DOCKER_VERSION:
+    if provider == "docker" and int(version.partition(".")[0]) < MINIMUM_DOCKER_VERSION:
         sys.stderr.write(
             "Docker version is too old (have %s), need >= %d\n"
             % (version, MINIMUM_DOCKER_VERSION)
@@ -221,33 +368,55 @@ def build_image(config, build_config):
             sys.stderr.write("Try changing 'config:pyrextag' to a different value\n")
             return None
 
+        # If the image source is unchanged since the last build and the
+        # image it produced still exists, the engine doesn't need to be
+        # invoked at all. A full (even fully cached) image build is a
+        # substantial daemon round trip
+        build_hash = get_build_hash(config)
+        last_buildid = build_config["build"].get("buildid")
+        if last_buildid and build_config["build"].get("buildhash") == build_hash:
+            try:
+                if get_image_id(config, tag) == last_buildid:
+                    build_config["build"]["runid"] = last_buildid
+                    return build_config
+            except subprocess.CalledProcessError:
+                pass
+
         print("Getting container image up to date...")
 
         (_, _, image_type) = config["config"]["image"].split("-")
 
         engine_args = shlex.split(config["imagebuild"]["buildcommand"])
 
-        for e in ("http_proxy", "https_proxy", "no_proxy"):
-            if e in os.environ:
-                engine_args.extend(["--build-arg", "%s=%s" % (e, os.environ[e])])
+        engine_args.extend(
+            arg
+            for e in PROXY_ENV_VARS
+            if e in os.environ
+            for arg in ("--build-arg", "%s=%s" % (e, os.environ[e]))
+        )
 
-        env = os.environ.copy()
-        for e in shlex.split(config["imagebuild"]["env"]):
-            name, val = e.split("=", 1)
-            env[name] = val
+        # Build the environment with a single dict display instead of
+        # copying os.environ and then mutating it, so the (potentially
+        # very large) environment is only materialized once
+        env = {
+            **os.environ,
+            **dict(e.split("=", 1) for e in shlex.split(config["imagebuild"]["env"])),
+        }
 
         try:
             if os.environ.get("PYREX_BUILD_QUIET", "1") == "1" and config[
                 "imagebuild"
             ].getboolean("quiet"):
                 engine_args.append("-q")
-                build_config["build"]["buildid"] = (
-                    subprocess.check_output(engine_args, env=env)
-                    .decode("utf-8")
-                    .rstrip()
-                )
+                build_config["build"]["buildid"] = subprocess.check_output(
+                    engine_args, env=env, universal_newlines=True
+                ).rstrip()
             else:
                 subprocess.check_call(engine_args, env=env)
+
+                # The build may have moved the tag, so don't trust a
+                # lookup cached before it ran
+                _image_id_cache.pop((engine, tag), None)
                 build_config["build"]["buildid"] = get_image_id(config, tag)
 
             build_config["build"]["runid"] = build_config["build"]["buildid"]
@@ -255,7 +424,7 @@ def build_image(config, build_config):
         except subprocess.CalledProcessError:
             return None
 
-        build_config["build"]["buildhash"] = get_build_hash(build_config)
+        build_config["build"]["buildhash"] = build_hash
     else:
         try:
             # Try to get the image This will fail if the image doesn't
@@ -275,6 +444,9 @@ def build_image(config, build_config):
     return build_config
 
 
+_build_hash_cache = {}
+
+
 def get_build_hash(config):
     # Docker doesn't currently have any sort of "dry-run" mechanism that could
     # be used to determine if the Dockerfile has changed and needs a rebuild.
@@ -283,54 +455,169 @@ def get_build_hash(config):
     # Until one is added, we use a simple hash of the files in the pyrex
     # "image" folder to determine when it is out of date.
 
-    h = hashlib.sha256()
-    for (root, dirs, files) in os.walk(os.path.join(PYREX_ROOT, "image")):
-        # Process files and directories in alphabetical order so that hashing
-        # is consistent
-        dirs.sort()
-        files.sort()
-
-        for f in files:
-            # Skip files that aren't interesting. This way any temporary editor
-            # files are ignored
-            if not (
-                f.endswith(".py")
-                or f.endswith(".sh")
-                or f.endswith(".patch")
-                or f == "Dockerfile"
-            ):
-                continue
+    def iter_files(top):
+        # Walk with os.scandir() instead of os.walk() so that the
+        # directory check uses the file type already returned by the
+        # kernel instead of an extra stat() per entry. Files and
+        # directories are processed in alphabetical order so that
+        # hashing is consistent
+        dirs = [top]
+        while dirs:
+            subdirs = []
+            with os.scandir(dirs.pop()) as it:
+                for entry in sorted(it, key=lambda e: e.name):
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                    elif (
+                        entry.name.endswith((".py", ".sh", ".patch"))
+                        or entry.name == "Dockerfile"
+                    ):
+                        # Files that aren't interesting are skipped. This
+                        # way any temporary editor files are ignored
+                        yield entry
+            dirs.extend(reversed(subdirs))
+
+    # The engine invocation shapes the image just as much as the files
+    # do: the expanded build command carries the tag, base image, and
+    # --target, and the proxy --build-arg values and build environment
+    # are baked into the result. Fold them all into the token so
+    # changing any of them invalidates a recorded build
+    config_values = (
+        config["imagebuild"]["buildcommand"],
+        config["imagebuild"]["env"],
+    ) + tuple(os.environ.get(e, "") for e in PROXY_ENV_VARS)
+
+    # A cheap stat fingerprint of the eligible files decides whether the
+    # contents actually need to be rehashed, so the common "nothing
+    # changed" case is O(files) stats instead of O(bytes) hashing
+    files = []
+    for entry in iter_files(os.path.join(PYREX_ROOT, "image")):
+        st = entry.stat()
+        files.append((entry.path, st.st_mtime_ns, st.st_size))
+
+    key = (config_values, tuple(files))
+    if key in _build_hash_cache:
+        return _build_hash_cache[key]
+
+    # The hash is only a staleness token, not a security boundary, so
+    # use BLAKE2b, which is substantially faster than SHA-256 in
+    # software while staying in the stdlib
+    import hashlib
+
+    h = hashlib.blake2b(digest_size=32)
+    for value in config_values:
+        h.update(value.encode("utf-8"))
+        h.update(b"\0")
+    for (path, _, size) in files:
+        # Mapping the file lets the hash consume it in a single C-level
+        # update instead of a Python-level 4KB read loop. Zero-length
+        # files can't be mapped (and contribute nothing anyway)
+        if not size:
+            continue
+        with open(path, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                h.update(mm)
+
+    build_hash = h.hexdigest()
+    _build_hash_cache[key] = build_hash
+    return build_hash
+
+
+@functools.lru_cache(maxsize=4)
+def query_engine_info(engine):
+    # The version query doubles as the check that the engine CLI
+    # actually works -- everything downstream execs it -- so it must go
+    # through the binary rather than the daemon API socket, which can
+    # answer even when the CLI is missing or broken
+    output = subprocess.check_output([engine, "--version"], universal_newlines=True)
+    m = ENGINE_VERSION_REGEX.match(output)
+    if m is not None:
+        return (m.group("provider").lower(), m.group("version"))
+    return (None, None)
 
-            with open(os.path.join(root, f), "rb") as f:
-                b = f.read(4096)
-                while b:
-                    h.update(b)
-                    b = f.read(4096)
 
-    return h.hexdigest()
+def get_engine_info(config):
+    # The engine binary doesn't change within a session, so the version
+    # query (a full fork + exec of the engine) is only done once per
+    # engine
+    return query_engine_info(config["config"]["engine"])
 
 
-def get_engine_info(config):
-    engine = config["config"]["engine"]
-    output = subprocess.check_output([engine, "--version"]).decode("utf-8")
-    m = re.match(r"(?P<provider>\S+) +version +(?P<version>[^\s,]+)", output)
-    if m is not None:
-        return (m.group("provider").lower(), m.group("version"))
-    return (None, None)
+@functools.lru_cache(maxsize=4)
+def get_subid_regex(name):
+    # The same user name is looked up in both /etc/subuid and
+    # /etc/subgid, so the compiled pattern is shared between the two
+    return re.compile(rb"(?m)^%s:\d+:(\d+)" % re.escape(name.encode("utf-8")))
 
 
 def get_subid_length(filename, name):
-    r = re.compile(r"{}:\d+:(\d+)".format(re.escape(name)))
+    r = get_subid_regex(name)
 
-    with open(filename, "r") as f:
-        for line in f:
-            m = r.match(line)
-            if m is not None:
-                return int(m.group(1))
+    # A single regex search over the memory mapped file avoids the
+    # line-by-line decode and match loop
+    with open(filename, "rb") as f:
+        try:
+            with mmap.mmap(f.fileno(), 0, prot=mmap.PROT_READ) as mapping:
+                m = r.search(mapping)
+                if m is not None:
+                    return int(m.group(1))
+        except ValueError:
+            # Empty files cannot be mapped
+            pass
 
     return 0
 
 
+@functools.lru_cache(maxsize=8)
+def get_subid_map_args(uid, gid, uid_length, gid_length):
+    # The rendered arguments only depend on the UID/GID pair, which
+    # never changes within a session, so cache the result
+    return (
+        # Fix up the UID/GID mapping so that the actual UID/GID
+        # inside the container maps to their actual UID/GID
+        # outside the container. Note that all offsets outside
+        # the container are relative to the start of the users
+        # subuid/subgid range.
+        # Map UID 0 up the actual user ID inside the container
+        # to the users subuid
+        "--uidmap",
+        "0:1:%d" % uid,
+        # Map the users actual UID inside the container to 0 in
+        # the users subuid namespace. The "root" user in the
+        # subuid namespace is special and maps to the users
+        # actual UID outside the namespace
+        "--uidmap",
+        "%d:0:1" % uid,
+        # Map the remaining UIDs after the actual user ID to
+        # continue using the users subuid range
+        "--uidmap",
+        "%d:%d:%d" % (uid + 1, uid + 1, uid_length - uid),
+        # Do the same for the GID
+        "--gidmap",
+        "0:1:%d" % gid,
+        "--gidmap",
+        "%d:0:1" % gid,
+        "--gidmap",
+        "%d:%d:%d" % (gid + 1, gid + 1, gid_length - gid),
+    )
+
+
+@functools.lru_cache(maxsize=8)
+def get_username(uid):
+    # NSS lookups can be slow (e.g. LDAP backed); the answer for a UID
+    # never changes within a session
+    import pwd
+
+    return pwd.getpwuid(uid).pw_name
+
+
+@functools.lru_cache(maxsize=8)
+def get_groupname(gid):
+    import grp
+
+    return grp.getgrgid(gid).gr_name
+
+
 def parse_bind_options(bind):
     options = types.SimpleNamespace(optional=False, readonly=False)
     bad_options = []
@@ -395,47 +682,64 @@ def prep_container(
 
     engine = config["config"]["engine"]
 
-    try:
-        buildid = get_image_id(config, runid)
-    except subprocess.CalledProcessError as e:
-        print("Cannot verify container image: %s\n" % e.output)
-        return []
+    # The image and staleness checks only produce warnings, so users
+    # who want the fastest possible container startup can skip them
+    if os.environ.get("PYREX_TRUST_BUILD") != "1":
+        try:
+            buildid = get_image_id(config, runid)
+        except subprocess.CalledProcessError as e:
+            print("Cannot verify container image: %s\n" % e.output)
+            return []
 
-    if buildid != build_config["build"]["buildid"]:
-        sys.stderr.write(
-            "WARNING: buildid for container image %s has changed\n" % runid
-        )
+        if buildid != build_config["build"]["buildid"]:
+            sys.stderr.write(
+                "WARNING: buildid for container image %s has changed\n" % runid
+            )
 
-    if config["config"]["buildlocal"] == "1" and build_config["build"][
-        "buildhash"
-    ] != get_build_hash(config):
-        sys.stderr.write(
-            "WARNING: The container image source has changed and should be rebuilt.\n"
-            "Try running: 'pyrex-rebuild'\n"
-        )
+        if config["config"]["buildlocal"] == "1" and build_config["build"][
+            "buildhash"
+        ] != get_build_hash(config):
+            sys.stderr.write(
+                "WARNING: The container image source has changed and should be rebuilt.\n"
+                "Try running: 'pyrex-rebuild'\n"
+            )
 
     uid = os.getuid()
     gid = os.getgid()
-    username = pwd.getpwuid(uid).pw_name
-    groupname = grp.getgrgid(gid).gr_name
+    try:
+        username = get_username(uid)
+        groupname = get_groupname(gid)
+    except KeyError:
+        print("Error: UID %d or GID %d is not known to this system" % (uid, gid))
+        return []
+
+    # Each value read through the section proxy re-runs interpolation,
+    # so fetch the section once and reuse it
+    run_config = config["run"]
 
+    # os.getgrouplist asks NSS for exactly this user's groups instead of
+    # scanning the entire group database in Python, which can take
+    # hundreds of ms on directory-backed systems
     groups = ["%d:%s" % (gid, groupname)]
 
-    for group in grp.getgrall():
-        if group.gr_name == groupname:
+    for group_gid in os.getgrouplist(username, gid):
+        if group_gid == gid:
             continue
-        if username in group.gr_mem:
-            groups.append("%d:%s" % (group.gr_gid, group.gr_name))
+        try:
+            groups.append("%d:%s" % (group_gid, get_groupname(group_gid)))
+        except KeyError:
+            # A group ID with no name can't be created in the container
+            pass
 
     # These are "hidden" keys in pyrex.ini that aren't publicized, and
     # are primarily used for testing. Use they at your own risk, they
     # may change
     if allow_test_config:
-        uid = int(config["run"].get("uid", uid))
-        username = config["run"].get("username") or username
-        groups = config["run"].get("groups", "").split() or groups
+        uid = int(run_config.get("uid", uid))
+        username = run_config.get("username") or username
+        groups = run_config.get("groups", "").split() or groups
 
-    command_prefix = config["run"].get("commandprefix", "").splitlines()
+    command_prefix = run_config.get("commandprefix", "").splitlines()
 
     engine_args = [
         engine,
@@ -474,11 +778,11 @@ def prep_container(
     # [1] https://docs.docker.com/config/containers/container-networking/
     # [2] https://github.com/docker/docker-ce/blob/master/components/cli/docs/reference/commandline/service_create.md
     engine_args.extend(
-        [
+        (
             "--net=host",
             "--mount",
             "type=bind,src=/etc/resolv.conf,dst=/etc/resolv.conf",
-        ]
+        )
     )
 
     container_envvars = [
@@ -500,38 +804,19 @@ def prep_container(
             sys.stderr.write("subgid name space is too small\n")
             sys.exit(1)
 
+        import resource
+
         (soft, hard) = resource.getrlimit(resource.RLIMIT_NOFILE)
 
         engine_args.extend(
-            [
+            (
                 "--security-opt",
                 "label=disable",
-                # Fix up the UID/GID mapping so that the actual UID/GID
-                # inside the container maps to their actual UID/GID
-                # outside the container. Note that all offsets outside
-                # the container are relative to the start of the users
-                # subuid/subgid range.
-                # Map UID 0 up the actual user ID inside the container
-                # to the users subuid
-                "--uidmap",
-                "0:1:%d" % uid,
-                # Map the users actual UID inside the container to 0 in
-                # the users subuid namespace. The "root" user in the
-                # subuid namespace is special and maps to the users
-                # actual UID outside the namespace
-                "--uidmap",
-                "%d:0:1" % uid,
-                # Map the remaining UIDs after the actual user ID to
-                # continue using the users subuid range
-                "--uidmap",
-                "%d:%d:%d" % (uid + 1, uid + 1, uid_length - uid),
-                # Do the same for the GID
-                "--gidmap",
-                "0:1:%d" % gid,
-                "--gidmap",
-                "%d:0:1" % gid,
-                "--gidmap",
-                "%d:%d:%d" % (gid + 1, gid + 1, gid_length - gid),
+            )
+        )
+        engine_args.extend(get_subid_map_args(uid, gid, uid_length, gid_length))
+        engine_args.extend(
+            (
                 # Set the rlimit for the number of open files to be the maximum
                 # hard limit, otherwise the hard limit will be pinned to the
                 # current soft limit (usually 1024), which is too low. The
@@ -539,7 +824,7 @@ def prep_container(
                 # https://github.com/containers/fuse-overlayfs/commit/d3729baa932bae444586ce9343bae59147ab2efb
                 "--ulimit",
                 "nofile=%d:%d" % (hard, hard),
-            ]
+            )
         )
 
     # Run the container with a TTY if this script was run in a tty
@@ -548,7 +833,7 @@ def prep_container(
 
     # Configure binds
     binds = (
-        config["run"]["bind"].split()
+        run_config["bind"].split()
         + os.environ.get("PYREX_CONFIG_BIND", "").split()
         + extra_bind
     )
@@ -556,7 +841,9 @@ def prep_container(
     binds_by_dst = {}
     prettyprinted_binds_by_dst = {}
 
-    for b in binds:
+    # dict.fromkeys drops exact duplicates in one pass while keeping
+    # the user's order, which matters for the mount list
+    for b in dict.fromkeys(binds):
         try:
             src, dst, options = parse_bind_options(b)
         except ParsingError as e:
@@ -585,21 +872,21 @@ def prep_container(
             return []
 
         engine_args.extend(
-            [
+            (
                 "--mount",
                 "type=bind,src={src},dst={dst}{ro}".format(
                     src=src, dst=dst, ro=",readonly" if options.readonly else ""
                 ),
-            ]
+            )
         )
 
-    container_envvars.extend(config["run"]["envvars"].split())
+    container_envvars.extend(run_config["envvars"].split())
     container_envvars.extend(extra_envvars)
 
     # Pass along extra environment variables
     for e in ("BB_ENV_EXTRAWHITE", "BB_ENV_PASSTHROUGH_ADDITIONS"):
         if e in os.environ:
-            engine_args.extend(["-e", e])
+            engine_args.extend(("-e", e))
             container_envvars.extend(os.environ[e].split())
 
     # Pass environment variables. If a variable passed with an argument
@@ -607,34 +894,31 @@ def prep_container(
     # empty value, where as Docker doesn't pass it at all. For
     # consistency, manually check if the variables exist before passing
     # them.
-    env_sock_proxy = config["run"]["envsockproxy"].split()
-    for name in set(container_envvars + preserve_env):
-        if name not in os.environ:
-            continue
-
+    env_sock_proxy = run_config["envsockproxy"].split()
+    for name in set(container_envvars + preserve_env) & os.environ.keys():
         val = os.environ[name]
 
         if name in env_sock_proxy:
-            socket = os.path.realpath(val)
-            if not os.path.exists(socket):
-                print("Warning: {} {} does not exist".format(name, socket))
+            sock_path = os.path.realpath(val)
+            if not os.path.exists(sock_path):
+                print("Warning: {} {} does not exist".format(name, sock_path))
             else:
                 dest = "/tmp/pyrex/sock/%s-%s" % (username, name)
                 engine_args.extend(
-                    [
+                    (
                         "--mount",
-                        "type=bind,src=%s,dst=%s" % (socket, dest),
+                        "type=bind,src=%s,dst=%s" % (sock_path, dest),
                         "-e",
                         "%s=%s" % (name, dest),
-                    ]
+                    )
                 )
         else:
-            engine_args.extend(["-e", name])
+            engine_args.extend(("-e", name))
 
     for k, v in extra_env.items():
-        engine_args.extend(["-e", "%s=%s" % (k, v)])
+        engine_args.extend(("-e", "%s=%s" % (k, v)))
 
-    engine_args.extend(shlex.split(config["run"].get("args", "")))
+    engine_args.extend(shlex.split(run_config.get("args", "")))
 
     engine_args.append("--")
     engine_args.append(runid)
@@ -642,91 +926,49 @@ def prep_container(
     return engine_args
 
 
+def write_script(path, content):
+    # Create the file with its final mode so no separate chmod pass is
+    # needed and there is no window where the script exists without its
+    # execute bits. fchmod covers restrictive umasks
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, stat.S_IRWXU)
+    try:
+        os.fchmod(fd, stat.S_IRWXU)
+        os.write(fd, content.encode("utf-8"))
+    finally:
+        os.close(fd)
+
+
 def create_shims(config, build_config, buildconf):
-    shimdir = os.path.join(build_config["tempdir"], "bin")
+    # Deferred so the hot run/config subcommands don't pay for it
+    import glob
 
-    try:
-        shutil.rmtree(shimdir)
-    except Exception:
-        pass
-    os.makedirs(shimdir)
+    shimdir = os.path.join(build_config["tempdir"], "bin")
 
-    # Write out run convenience command
     runfile = os.path.join(shimdir, "pyrex-run")
-    with open(runfile, "w") as f:
-        f.write(
-            textwrap.dedent(
-                """\
-            #! /bin/sh
-            exec {this_script} run {conffile} -- "$@"
-            """.format(
-                    this_script=THIS_SCRIPT, conffile=buildconf
-                )
-            )
-        )
-    os.chmod(runfile, stat.S_IRWXU)
-
-    # write out config convenience command
-    configcmd = os.path.join(shimdir, "pyrex-config")
-    with open(configcmd, "w") as f:
-        f.write(
-            textwrap.dedent(
-                """\
-            #! /bin/sh
-            exec {this_script} config {conffile} "$@"
-            """.format(
-                    this_script=THIS_SCRIPT, conffile=buildconf
-                )
-            )
-        )
-    os.chmod(configcmd, stat.S_IRWXU)
-
-    # write out the shim file
-    shimfile = os.path.join(shimdir, "exec-shim-pyrex")
-    with open(shimfile, "w") as f:
-        f.write(
-            textwrap.dedent(
-                """\
-            #! /bin/sh
-            exec {runfile} "$(basename $0)" "$@"
-            """.format(
-                    runfile=runfile
-                )
-            )
-        )
-    os.chmod(shimfile, stat.S_IRWXU)
-
-    # write out the shell convenience command
-    shellfile = os.path.join(shimdir, "pyrex-shell")
-    with open(shellfile, "w") as f:
-        f.write(
-            textwrap.dedent(
-                """\
-            #! /bin/sh
-            exec {runfile} {shell} "$@"
-            """.format(
-                    runfile=runfile, shell=build_config["container"]["shell"]
-                )
-            )
-        )
-    os.chmod(shellfile, stat.S_IRWXU)
-
-    # write out image rebuild command
-    rebuildfile = os.path.join(shimdir, "pyrex-rebuild")
-    with open(rebuildfile, "w") as f:
-        f.write(
-            textwrap.dedent(
-                """\
-            #! /bin/sh
-            exec {this_script} rebuild {conffile}
-            """.format(
-                    this_script=THIS_SCRIPT, conffile=buildconf
-                )
-            )
-        )
-    os.chmod(rebuildfile, stat.S_IRWXU)
 
-    # Create shims
+    # The convenience commands and the shim file
+    scripts = {
+        # run convenience command
+        "pyrex-run": RUN_SCRIPT_TEMPLATE.format(
+            this_script=THIS_SCRIPT, conffile=buildconf
+        ),
+        # config convenience command
+        "pyrex-config": CONFIG_SCRIPT_TEMPLATE.format(
+            this_script=THIS_SCRIPT, conffile=buildconf
+        ),
+        # shim file
+        "exec-shim-pyrex": EXEC_SHIM_TEMPLATE.format(runfile=runfile),
+        # shell convenience command
+        "pyrex-shell": SHELL_SCRIPT_TEMPLATE.format(
+            runfile=runfile, shell=build_config["container"]["shell"]
+        ),
+        # image rebuild command
+        "pyrex-rebuild": REBUILD_SCRIPT_TEMPLATE.format(
+            this_script=THIS_SCRIPT, conffile=buildconf
+        ),
+    }
+
+    # Collect shims
     user_commands = config["config"].get("commands")
     if user_commands:
         user_commands = user_commands.split()
@@ -737,31 +979,117 @@ def create_shims(config, build_config, buildconf):
         nopyrex_globs = build_config["container"].get("commands", {}).get("exclude", {})
 
     commands = set()
+    links = {}
 
     def add_commands(globs, target):
         nonlocal commands
 
-        for g in globs:
-            for cmd in glob.iglob(g):
-                norm_cmd = os.path.normpath(cmd)
+        def scan_dir(dirname, patterns):
+            try:
+                with os.scandir(dirname) as it:
+                    entries = sorted(it, key=lambda e: e.name)
+            except OSError:
+                return
+
+            for entry in entries:
+                for p in patterns:
+                    # Like glob, wildcards don't match hidden files
+                    if entry.name.startswith(".") and not p.startswith("."):
+                        continue
+                    if fnmatch.fnmatchcase(entry.name, p):
+                        break
+                else:
+                    continue
+
                 if (
-                    norm_cmd not in commands
-                    and os.path.isfile(cmd)
-                    and os.access(cmd, os.X_OK)
+                    entry.path not in commands
+                    and entry.is_file()
+                    and os.access(entry.path, os.X_OK)
                 ):
-                    commands.add(norm_cmd)
-                    name = os.path.basename(cmd)
+                    commands.add(entry.path)
+                    links.setdefault(entry.name, target.format(command=entry.path))
+
+        # Group the glob patterns by directory so that each directory is
+        # only listed once, no matter how many patterns it appears in,
+        # and so the file check can use the type os.scandir already
+        # fetched instead of a stat() per candidate
+        # Normalizing the directory here (once per pattern) means the
+        # paths built from the scan are already normalized, so no
+        # per-candidate normpath is needed for the dedup set
+        patterns_by_dir = {}
+        for g in globs:
+            (dirname, basename) = os.path.split(g)
+            patterns_by_dir.setdefault(os.path.normpath(dirname or "."), []).append(
+                basename
+            )
 
-                    os.symlink(target.format(command=cmd), os.path.join(shimdir, name))
+        for dirname, patterns in patterns_by_dir.items():
+            if glob.has_magic(dirname):
+                # Wildcards in the directory portion are rare; let glob
+                # expand them, then scan each match
+                for d in sorted(glob.iglob(dirname)):
+                    scan_dir(d, patterns)
+            else:
+                scan_dir(dirname, patterns)
 
     add_commands(nopyrex_globs, "{command}")
     add_commands(command_globs, "exec-shim-pyrex")
 
+    # Synchronize the shim directory with the desired contents instead
+    # of deleting and recreating it from scratch. In the common case
+    # where nothing has changed this is a read-only pass with no
+    # unlink/symlink churn
+    os.makedirs(shimdir, exist_ok=True)
+
+    with os.scandir(shimdir) as it:
+        existing = list(it)
+
+    for entry in existing:
+        if entry.is_symlink():
+            if links.get(entry.name) == os.readlink(entry.path):
+                # Link is already correct
+                del links[entry.name]
+                continue
+        elif entry.is_file():
+            if (
+                entry.name in scripts
+                and stat.S_IMODE(entry.stat().st_mode) == stat.S_IRWXU
+            ):
+                with open(entry.path, "r") as f:
+                    if f.read() == scripts[entry.name]:
+                        # Script is already correct
+                        del scripts[entry.name]
+                        continue
+
+        # Anything else is stale and has to go
+        if entry.is_dir(follow_symlinks=False):
+            import shutil
+
+            shutil.rmtree(entry.path)
+        else:
+            os.unlink(entry.path)
+
+    for name, content in scripts.items():
+        write_script(os.path.join(shimdir, name), content)
+
+    if links:
+        # Creating the links relative to an open directory fd saves the
+        # kernel a full path walk of shimdir per symlink
+        shimdir_fd = os.open(shimdir, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            for name, link_target in links.items():
+                os.symlink(link_target, name, dir_fd=shimdir_fd)
+        finally:
+            os.close(shimdir_fd)
+
     return shimdir
 
 
 def main():
     def capture(args):
+        # Deferred so the hot run/config subcommands don't pay for it
+        import tempfile
+
         config = load_config()
         build_config = build_image(config, {})
         if build_config is None:
@@ -809,22 +1137,22 @@ def main():
         with open(buildconf, "w") as f:
             json.dump(build_config, f)
 
-        def write_cmd(c):
-            os.write(args.fd, c.encode("utf-8"))
-            os.write(args.fd, "\n".encode("utf-8"))
-
-        write_cmd("PATH=%s:$PATH" % build_config["shimdir"])
+        # Gather all of the shell commands and emit them with a single
+        # write instead of a pair of syscalls per line
+        cmds = ["PATH=%s:$PATH" % build_config["shimdir"]]
         user_export = capture["user"].get("export", {})
         for name in sorted(user_export.keys()):
-            write_cmd('export %s="%s"' % (name, user_export[name]))
+            cmds.append('export %s="%s"' % (name, user_export[name]))
         if capture["user"].get("cwd"):
-            write_cmd('cd "%s"' % capture["user"]["cwd"])
+            cmds.append('cd "%s"' % capture["user"]["cwd"])
+        cmds.append("")
+
+        os.write(args.fd, "\n".join(cmds).encode("utf-8"))
         return 0
 
     def rebuild(args):
         config = load_config()
-        with open(args.buildconf, "r") as f:
-            build_config = json.load(f)
+        build_config = load_build_config(args.buildconf)
 
         build_config = build_image(config, build_config)
 
@@ -840,8 +1168,7 @@ def main():
 
     def run(args):
         config = load_config()
-        with open(args.buildconf, "r") as f:
-            build_config = json.load(f)
+        build_config = load_build_config(args.buildconf)
 
         engine_args = prep_container(
             config,
@@ -855,7 +1182,15 @@ def main():
             sys.exit(1)
 
         stop_coverage()
-        os.execvp(engine_args[0], engine_args)
+        # Resolve the engine to an absolute path up front so the exec
+        # doesn't have to probe each $PATH entry itself
+        import shutil
+
+        engine_path = shutil.which(engine_args[0])
+        if engine_path is not None:
+            os.execv(engine_path, engine_args)
+        else:
+            os.execvp(engine_args[0], engine_args)
         print("Cannot exec container!")
         sys.exit(1)
 